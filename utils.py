@@ -1,33 +1,75 @@
 import csv
 import re
+import sys
 
-from typing import List
+from collections.abc import Sized
+from functools import lru_cache
+from typing import Iterator, List
 
+import numpy as np
 import pandas as pd
 
 
-def extract_features_from_action(phrase) -> tuple:
+_ACTION_END_RE = re.compile(r'[(<$1]')  # the action stops at the first of these characters
+_NO_MATCH = (None, None, None, None)
+_ACTION_COLUMN, _TIME_COLUMN, _EMPTY_COLUMN = 0, 1, -1  # kinds returned by _classify_column
+
+
+def _classify_column(column: str) -> int:
+    """
+    Classifies a row column as an action, a time of the form t-number or an empty column
+    """
+    if not column:
+        return _EMPTY_COLUMN
+    if column.startswith('t') and column[1:].isdecimal():
+        return _TIME_COLUMN
+    return _ACTION_COLUMN
+
+
+def _parse_action(phrase: str) -> tuple:
+    """
+    Splits a stripped phrase of the form action(screen)<configuration>$chaine$
+    into its raw components using a character-class search for the action end
+    and str.find for the groups.
+
+    Returns _NO_MATCH when the phrase does not follow the pattern.
+    """
+    end = len(phrase)
+
+    # action: anything before the first (, <, $ or 1 (found in a single scan)
+    action_end = _ACTION_END_RE.search(phrase)
+    i = action_end.start() if action_end else end
+    action = phrase[:i]
+
+    groups = [action]
+    for opening, closing in (('(', ')'), ('<', '>'), ('$', '$')):
+        if i < end and phrase[i] == opening:
+            j = phrase.find(closing, i + 1)
+            if j <= i + 1:  # unclosed or empty group
+                return _NO_MATCH
+            groups.append(phrase[i + 1:j])
+            i = j + 1
+        else:
+            groups.append(None)
+
+    if i != end:
+        return _NO_MATCH
+
+    return tuple(groups)
+
+
+@lru_cache(maxsize=100_000)
+def extract_features_from_action(phrase: str) -> tuple:
     """
     Extracts components from a phrase with the pattern:
     action(screen)<configuration>$chaine$
 
     Returns a tuple of (action, screen, configuration, chaine) where each
     element is None if not present.
+    Results are cached since the same phrases repeat a lot across sessions.
     """
 
-    # More flexible pattern to handle optional components
-    match = re.match(
-        r'^([^(<$1]+)?'  # action (anything before (, <, $, or 1)
-        r'(?:\(([^)]+)\))?'  # optional screen in parentheses
-        r'(?:<([^>]+)>)?'  # optional configuration in angle brackets
-        r'(?:\$([^$]+)\$)?$',  # optional chaine in dollar signs
-        phrase.strip()
-    )
-
-    if not match:
-        return None, None, None, None
-
-    action, screen, configuration, chaine = match.groups()
+    action, screen, configuration, chaine = _parse_action(phrase.strip())
 
     # Clean up whitespace
     action = action.strip() if action else None
@@ -35,12 +77,12 @@ def extract_features_from_action(phrase) -> tuple:
     configuration = configuration.strip() if configuration else None
     chaine = chaine.strip().lower() if chaine else None
 
-    # Return None for empty strings
+    # Return None for empty strings, intern the others since they repeat a lot
     return (
-        action if action and not re.match(r'^t\d+$', str(action)) else None,
-        screen if screen else None,
-        configuration if configuration else None,
-        chaine if chaine else None
+        sys.intern(action) if action and _classify_column(action) == _ACTION_COLUMN else None,
+        sys.intern(screen) if screen else None,
+        sys.intern(configuration) if configuration else None,
+        sys.intern(chaine) if chaine else None
     )
 
 
@@ -55,13 +97,52 @@ def read_csv_file(file_path: str, has_header: bool = True) -> List[List[str]]:
         for row in reader:
             rows.append(row)
 
-    if has_header:
-        header = rows[0]
-        data = rows[1:]
-        return [header] + data
+    # the header, when present, is already the first row
     return rows
 
 
+def read_csv_iter(file_path: str) -> Iterator[List[str]]:
+    """
+    Reads a CSV file lazily, yielding one row at a time.
+    """
+    with open(file_path, newline='', encoding='utf-8') as f:
+        yield from csv.reader(f)
+
+
+def _make_row_feature_positions(action_idx, screen_idx, configuration_idx, chaine_idx):
+    """
+    Builds a function specialised for the given features that returns the
+    occurrence column positions of the parsed actions of a row and whether
+    the row uses french.
+
+    Since the features are frozen, the positions of each distinct parsed
+    action are resolved once and reused for the following rows.
+    """
+    resolved = {}
+
+    def row_feature_positions(parsed_actions) -> tuple:
+        feature_positions = []
+        uses_fr = 0
+        for parsed_action in parsed_actions:
+            cached = resolved.get(parsed_action)
+            if cached is None:
+                trimmed_action, screen, configuration, chaine = parsed_action
+                positions = tuple(
+                    idx[feature]
+                    for idx, feature in ((action_idx, trimmed_action), (screen_idx, screen),
+                                         (configuration_idx, configuration), (chaine_idx, chaine))
+                    if feature in idx
+                )
+                is_fr = int(screen is not None and screen.startswith("fr"))
+                cached = resolved[parsed_action] = (positions, is_fr)
+            positions, is_fr = cached
+            feature_positions.extend(positions)
+            uses_fr |= is_fr
+        return feature_positions, uses_fr
+
+    return row_feature_positions
+
+
 class CSVDataProcessor:
     """
     Utility class designed to process training and testing CSV files containing user session data.
@@ -77,10 +158,21 @@ class CSVDataProcessor:
         self.is_training_data = None
         self.headers = None
 
-        self.possible_actions_set = set()
-        self.possible_screens_set = set()
-        self.possible_configurations_set = set()
-        self.possible_chaines_set= set()
+        # sorted vocabularies, frozen once the features are extracted
+        self.possible_actions = ()
+        self.possible_screens = ()
+        self.possible_configurations = ()
+        self.possible_chaines = ()
+
+        # feature -> occurrence column position, built once the features are extracted
+        self._action_idx = {}
+        self._screen_idx = {}
+        self._configuration_idx = {}
+        self._chaine_idx = {}
+        self._row_feature_positions = None  # built by create_headers
+
+        # parsed actions of each train row, kept between the two passes over the data
+        self._parsed = None
 
     def __enter__(self):
         self._initialise()
@@ -105,22 +197,38 @@ class CSVDataProcessor:
         - All screens
         - All configurations
         - All chaines
+
+        The parsed actions of every row are also kept in self._parsed so that
+        processing the train data does not parse them again.
         """
         index = 1
         if self.is_training_data:
             index = 2
 
+        possible_actions_set = set()
+        possible_screens_set = set()
+        possible_configurations_set = set()
+        possible_chaines_set = set()
+
+        self._parsed = []
         for row in self.data:
-            for action in row[index:]:
-                trimmed_action, screen, configuration, chaine = extract_features_from_action(action)
+            parsed_row = [extract_features_from_action(action) for action in row[index:]]
+            self._parsed.append(parsed_row)
+            for trimmed_action, screen, configuration, chaine in parsed_row:
                 if trimmed_action is not None:
-                    self.possible_actions_set.add(trimmed_action)
+                    possible_actions_set.add(trimmed_action)
                 if screen is not None:
-                    self.possible_screens_set.add(screen)
+                    possible_screens_set.add(screen)
                 if configuration is not None:
-                    self.possible_configurations_set.add(configuration)
+                    possible_configurations_set.add(configuration)
                 if chaine is not None:
-                    self.possible_chaines_set.add(chaine)
+                    possible_chaines_set.add(chaine)
+
+        # freeze the vocabularies so that the columns order is stable between runs
+        self.possible_actions = tuple(sorted(possible_actions_set))
+        self.possible_screens = tuple(sorted(possible_screens_set))
+        self.possible_configurations = tuple(sorted(possible_configurations_set))
+        self.possible_chaines = tuple(sorted(possible_chaines_set))
 
     def create_headers(self) -> list:
         """
@@ -131,17 +239,29 @@ class CSVDataProcessor:
             initial_columns.insert(0, "user")
             self.extract_all_possible_features()
 
+        # map every feature to its position among the occurrence columns
+        offset = 0
+        self._action_idx = {action: offset + i for i, action in enumerate(self.possible_actions)}
+        offset += len(self.possible_actions)
+        self._screen_idx = {screen: offset + i for i, screen in enumerate(self.possible_screens)}
+        offset += len(self.possible_screens)
+        self._configuration_idx = {config: offset + i for i, config in enumerate(self.possible_configurations)}
+        offset += len(self.possible_configurations)
+        self._chaine_idx = {chaine: offset + i for i, chaine in enumerate(self.possible_chaines)}
+        self._row_feature_positions = _make_row_feature_positions(
+            self._action_idx, self._screen_idx, self._configuration_idx, self._chaine_idx)
+
         # 1. possible actions features
-        possible_actions_str = [f"occurrence of action '{action}' " for action in self.possible_actions_set]
+        possible_actions_str = [f"occurrence of action '{action}' " for action in self.possible_actions]
 
         # 2. possible screens features
-        possible_screens_str = [f"occurrence of screen '{screen}' " for screen in self.possible_screens_set]
+        possible_screens_str = [f"occurrence of screen '{screen}' " for screen in self.possible_screens]
 
         # 3. possible configuration features
-        possible_configurations_str = [f"occurrence of configuration '{config}' " for config in self.possible_configurations_set]
+        possible_configurations_str = [f"occurrence of configuration '{config}' " for config in self.possible_configurations]
 
         # 4. possible chaines features
-        possible_chaine_str = [f"occurrence of chaine '{chaine}' " for chaine in self.possible_chaines_set]
+        possible_chaine_str = [f"occurrence of chaine '{chaine}' " for chaine in self.possible_chaines]
 
 
         # # # add the headers
@@ -149,7 +269,7 @@ class CSVDataProcessor:
 
         return initial_columns + possible_actions_str + possible_screens_str + possible_configurations_str + possible_chaine_str
 
-    def extract_data_from_row(self, row) -> list:
+    def extract_data_from_row(self, row, parsed_actions=None) -> tuple:
         """
         Extracts, computes and returns the following data from each row:
         - user (in the case of train.csv)
@@ -157,10 +277,11 @@ class CSVDataProcessor:
         - Total number of actions in each session
         - Session duration
         - Average speed during the session
-        - occurrences of each unique action
-        - occurrences of each screen
-        - occurrences of each configuration
-        - occurrences of each chaine
+        - Whether the user uses french
+
+        along with the occurrence column position of every action, screen,
+        configuration and chaine found in the row (one entry per occurrence).
+        parsed_actions can hold the already parsed actions of the row.
         """
         result_row = []
 
@@ -171,71 +292,93 @@ class CSVDataProcessor:
         result_row.append(row[0]) # 1. add the navigator
 
         actions = row[1:]
-        all_actions = [action for action in actions if not re.match(r'^t\d+$', str(action)) ] # ignore columns with the form t-number
 
-        total_actions = len(all_actions)
-        result_row.append(total_actions) # 2. add total actions
-
-
-        times = [action for action in actions if re.match(r'^t\d+$', str(action)) ] # get the times (form t-number)
+        # count the actions and keep the last time (form t-number) in a single pass
+        total_actions = 0
+        session_duration = 0
+        for action in actions:
+            kind = _classify_column(action)
+            if kind == _TIME_COLUMN:
+                session_duration = int(action[1:])
+            elif kind == _ACTION_COLUMN:
+                total_actions += 1
 
-        # get the last time and remove the initial t
-        session_duration = times[-1][1:]
+        result_row.append(total_actions) # 2. add total actions
 
         result_row.append(session_duration) # 3. add session duration
 
-
-        avg_speed = total_actions/int(session_duration) if int(session_duration) > 0 else 0
+        avg_speed = total_actions/session_duration if session_duration > 0 else 0
         result_row.append(avg_speed) # 4. add average speed
 
-        uses_fr = 0
-
-        # calculate the nbr of occurrences of all action related features
-        possible_actions_occurrences = {}
-        screens_occurrences = {}
-        configurations_occurrences = {}
-        chaines_occurrences = {}
+        # collect the positions of all action related features
+        # (features unseen in the train data are ignored)
+        if parsed_actions is None:
+            parsed_actions = [extract_features_from_action(action) for action in actions]
 
-        for action in actions:
-            trimmed_action, screen, configuration, chaine = extract_features_from_action(action)
-            if trimmed_action is not None:
-                possible_actions_occurrences[trimmed_action] = possible_actions_occurrences.get(trimmed_action, 0) +1
-            if screen is not None:
-                if screen.startswith("fr"):
-                    uses_fr = 1
-                screens_occurrences[screen] = screens_occurrences.get(screen, 0) +1
-            if configuration is not None:
-                configurations_occurrences[configuration] = configurations_occurrences.get(configuration, 0) + 1
-            if chaine is not None:
-                chaines_occurrences[chaine] = chaines_occurrences.get(chaine, 0) + 1
+        feature_positions, uses_fr = self._row_feature_positions(parsed_actions)
 
         # 5. Add if the user uses french
         result_row.append(uses_fr)
 
-        # 6. add occurrences those occurrences to result row (warning the order is important)
-        result_row.extend([possible_actions_occurrences.get(possible_action, 0) for possible_action in self.possible_actions_set ])
-        result_row.extend([screens_occurrences.get(screen, 0) for screen in self.possible_screens_set ])
-        result_row.extend([configurations_occurrences.get(config, 0) for config in self.possible_configurations_set ])
-        result_row.extend([chaines_occurrences.get(chaine, 0) for chaine in self.possible_chaines_set ])
-
-        return result_row
+        return result_row, feature_positions
 
-    def process_data(self, data=None, is_training_data = True):
+    def process_data(self, data=None, is_training_data = True, return_array=False):
         """
-        Entry point for processing train or test csv data
+        Entry point for processing train or test csv data.
+        data can be a list of rows or any iterable of rows (e.g. read_csv_iter),
+        in which case the rows are processed as they are read.
+        With return_array, returns a (session columns, occurrences, headers) tuple instead of
+        a DataFrame: the session columns as an object array, the occurrence columns as an
+        int32 array and the headers of both, in order.
         """
         headers = self.headers
+        rows = self.data
         if not is_training_data :
             assert data is not None, "Data can not be None when processing test csv file"
-            self.data = data
+            # test rows are not kept on the instance, a stream can only be read once
+            rows = data
             headers=self.headers[1:]
 
         self.is_training_data = is_training_data
-        processed_csv_data = [ self.extract_data_from_row(row) for row in self.data]
-
-        return pd.DataFrame(data= processed_csv_data, columns=headers)
+        n_features = len(self.possible_actions) + len(self.possible_screens) \
+            + len(self.possible_configurations) + len(self.possible_chaines)
+        n_initial_columns = len(headers) - n_features
+
+        processed_csv_data = []
+        # the number of streamed rows is unknown, so the matrix grows as needed
+        n_rows = len(rows) if isinstance(rows, Sized) else 1024
+        occurrences = np.zeros((n_rows, n_features), dtype=np.int32)
+        for row_index, (result_row, row_feature_positions) in enumerate(self._process_rows(rows)):
+            if row_index == len(occurrences):
+                occurrences = np.concatenate([occurrences, np.zeros_like(occurrences)])
+            processed_csv_data.append(result_row)
+            # count the occurrences of every feature of the row
+            occurrences[row_index] = np.bincount(row_feature_positions, minlength=n_features)
+        if is_training_data:
+            # the train rows have used the cached parse, release it
+            self._parsed = None
+        occurrences = occurrences[:len(processed_csv_data)]
+
+        if return_array:
+            # keep the occurrences apart so they are not boxed into the object array
+            initial_data = np.array(processed_csv_data, dtype=object).reshape(len(processed_csv_data), n_initial_columns)
+            return initial_data, occurrences, headers
+
+        initial_data = pd.DataFrame(data=processed_csv_data, columns=headers[:n_initial_columns])
+        occurrences_data = pd.DataFrame(data=occurrences, columns=headers[n_initial_columns:])
+        return pd.concat([initial_data, occurrences_data], axis=1)
+
+    def _process_rows(self, rows):
+        """
+        Yields the processed rows, in order.
+        """
+        if self.is_training_data and self._parsed is not None:
+            # reuse the actions parsed while extracting the train features
+            yield from map(self.extract_data_from_row, rows, self._parsed)
+        else:
+            yield from map(self.extract_data_from_row, rows)
 
-    def get_processed_train_data(self):
+    def get_processed_train_data(self, return_array=False):
         """
         returns the processed train data
         """
@@ -244,18 +387,18 @@ class CSVDataProcessor:
             # should initialise before processing
             self._initialise()
 
-        return self.process_data(is_training_data=True)
+        return self.process_data(is_training_data=True, return_array=return_array)
 
-    def get_processed_test_data(self, test_data_csv_path):
+    def get_processed_test_data(self, test_data_csv_path, return_array=False):
         """
         returns the processed test data
         """
         if self.headers is None:
             self._initialise()
 
-        test_data = read_csv_file(test_data_csv_path)
+        test_data = read_csv_iter(test_data_csv_path)
         self.is_training_data = False
 
-        return self.process_data(data=test_data, is_training_data=False)
+        return self.process_data(data=test_data, is_training_data=False, return_array=return_array)
 
 